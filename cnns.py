@@ -8,18 +8,49 @@ import wandb
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 from opacus import PrivacyEngine
 
-from train_utils import get_device, train, test
-from data import get_data, get_scatter_transform, get_scattered_loader
+from train_utils import get_device, train, test, CUDAGraphForward, get_optimizer_kwargs, \
+    main_process_first, average_gradients, skip_allreduce_hook, compile_model
+from log import BackgroundLogger
+from data import get_data, get_scatter_transform, get_scatter_backend, get_scattered_loader, \
+    get_loader_kwargs, to_tensor_dataset, get_augmentation
 from models import CNNS, get_num_params
-from dp_utils import ORDERS, get_privacy_spent, get_renyi_divergence, scatter_normalization
+from dp_utils import ORDERS, get_privacy_spent, get_renyi_divergence, scatter_normalization, \
+    VmapPrivacyEngine
+
+NUM_WORKERS = min(8, os.cpu_count() or 1)
+
+
+def to_cpu(state):
+    # copy all tensors in a (nested) state dict to the CPU
+    if torch.is_tensor(state):
+        return state.cpu()
+    if isinstance(state, dict):
+        return {k: to_cpu(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(to_cpu(v) for v in state)
+    return state
+
+
+def get_state_dict(model):
+    # the state dict of a model, with the keys it would have without
+    # `torch.compile` (which prefixes the keys of the compiled module with
+    # `_orig_mod.`)
+    return {k.replace("_orig_mod.", ""): v for k, v in model.state_dict().items()}
 
 
 def save_checkpoint(state, is_best, filename="checkpoint.tar"):
-    torch.save(state, filename)
+    # write to a temporary file and rename it, so that an interrupted run
+    # never leaves a truncated checkpoint behind
+    tmp_filename = f"{filename}.tmp"
+    torch.save(to_cpu(state), tmp_filename, _use_new_zipfile_serialization=True)
+    os.replace(tmp_filename, filename)
     if is_best:
-        shutil.copyfile(filename, f"{filename}_best")
+        shutil.copyfile(filename, tmp_filename)
+        os.replace(tmp_filename, f"{filename}_best")
 
 
 def main(dataset, seed=0, augment=False, use_scattering=True, size=None,
@@ -27,17 +58,38 @@ def main(dataset, seed=0, augment=False, use_scattering=True, size=None,
          lr=1, optim="SGD", momentum=0.9, nesterov=False,
          noise_multiplier=1, max_grad_norm=0.1, epochs=100,
          input_norm=None, num_groups=None, bn_noise_multiplier=None,
-         max_epsilon=None, out_dir="out", early_stop=True, device="cuda"):
+         max_epsilon=None, out_dir="out", early_stop=True, device="cuda",
+         num_workers=NUM_WORKERS, persistent_workers=True, grad_sample_mode="hooks",
+         bf16=False, compile_model=False, cuda_graph=False, channels_last=False,
+         fp16_allreduce=False):
+
+    # when launched with `torchrun`, train on one GPU per process
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    distributed = world_size > 1
+    if distributed:
+        local_rank = int(os.environ["LOCAL_RANK"])
+        torch.cuda.set_device(local_rank)
+        dist.init_process_group("nccl")
+        rank = dist.get_rank()
+        device = f"cuda:{local_rank}"
+    else:
+        rank = 0
 
     random.seed(seed)
     torch.manual_seed(seed)
     np.random.seed(seed)
 
+    # all batches have the same shape, so let cuDNN pick the fastest
+    # convolution algorithms, and allow TF32 math on Ampere GPUs (torch>=1.7)
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cudnn.allow_tf32 = True
+    if hasattr(torch.backends.cuda, "matmul"):
+        torch.backends.cuda.matmul.allow_tf32 = True
+
     # Log run.
     run_name = f"cifar10_scatternet_{noise_multiplier}"
     run_dir = pathlib.Path(out_dir) / run_name
-    if not run_dir.is_dir():
-        run_dir.mkdir(parents=True)
+    run_dir.mkdir(parents=True, exist_ok=True)
     checkpoint_filename = run_dir / f"model_{seed}"
     run_params = {
         "project": "multiplicities",
@@ -54,26 +106,59 @@ def main(dataset, seed=0, augment=False, use_scattering=True, size=None,
             "lr": lr,
         },
     }
+    if rank != 0:
+        # only the main process logs
+        run_params["mode"] = "disabled"
     run = wandb.init(**run_params, name=f"model_{seed}")
 
     device = get_device(device)
-    train_data, test_data = get_data(dataset, augment=augment)
+    # data augmentation and normalization are applied on the device
+    train_data, test_data = get_data(dataset, normalize=not augment)
+    augmentation = get_augmentation(dataset).to(device) if augment else None
 
     if use_scattering:
-        scattering, K, _ = get_scatter_transform(dataset)
+        # use the cuFFT-based backend if it's installed
+        scatter_backend = get_scatter_backend()
+        scattering, K, _ = get_scatter_transform(dataset, backend=scatter_backend)
         scattering.to(device)
     else:
         scattering = None
+        scatter_backend = "torch"
         K = 3 if len(train_data.data.shape) == 4 else 1
 
+    # load the data into memory once. When augmenting, the images are kept as
+    # uint8, and converted to floats on the device.
+    train_data = to_tensor_dataset(train_data, raw=augment)
+    test_data = to_tensor_dataset(test_data, raw=augment)
+
     bs = batch_size
+    if grad_sample_mode == "vmap":
+        # compute the per-sample gradients of a whole batch in a single call,
+        # rather than accumulating them over mini-batches
+        mini_batch_size = bs
     assert bs % mini_batch_size == 0
     n_acc_steps = bs // mini_batch_size
 
+    if distributed:
+        # each process computes the gradients of an equal share of every
+        # (mini-)batch. The total batch size, and hence the sampling rate used
+        # in the privacy analysis, stays the same.
+        assert mini_batch_size % world_size == 0
+        mini_batch_size //= world_size
+
+    # mixed-precision training in bfloat16 needs torch>=1.10. opacus computes the
+    # per-sample gradients in its backward hooks from bfloat16 gradients and
+    # float32 activations, so this only works with the vmap privacy engine.
+    if bf16:
+        assert hasattr(torch, "autocast")
+        assert grad_sample_mode == "vmap"
+    autocast_dtype = torch.bfloat16 if bf16 else None
+
     # Batch accumulation and data augmentation with Poisson sampling isn't implemented
     if sample_batches:
         assert n_acc_steps == 1
         assert not augment
+        assert not distributed
 
     # def seed_worker(worker_id):
     #     worker_seed = worker_id
@@ -86,126 +171,245 @@ def main(dataset, seed=0, augment=False, use_scattering=True, size=None,
     test_gen = torch.Generator()
     test_gen.manual_seed(0)
 
+    loader_kwargs = get_loader_kwargs(num_workers, persistent_workers)
+
+    # when augmenting, this loader is used for training. Otherwise, it's only
+    # used to pre-compute the features, and `get_scattered_loader` takes care
+    # of dropping the last batch and sharding the data.
+    train_sampler = None
+    if distributed and augment:
+        train_sampler = torch.utils.data.DistributedSampler(train_data, drop_last=True)
+
     train_loader = torch.utils.data.DataLoader(
-        train_data, batch_size=mini_batch_size, shuffle=True, num_workers=1, pin_memory=True,
+        train_data, batch_size=mini_batch_size, shuffle=train_sampler is None,
+        sampler=train_sampler, drop_last=augment, **loader_kwargs,
         # worker_init_fn=seed_worker,
         generator=train_gen,
     )
 
     test_loader = torch.utils.data.DataLoader(
-        test_data, batch_size=mini_batch_size, shuffle=False, num_workers=1, pin_memory=True,
+        test_data, batch_size=mini_batch_size, shuffle=False, **loader_kwargs,
         # worker_init_fn=seed_worker,
         generator=test_gen,
     )
 
 
+    if not augment:
+        # pre-compute the scattering transform if necessery, and cache it
+        # on disk so that later runs can skip it. The features (and their order,
+        # as the data is shuffled with a fixed seed) only depend on the dataset
+        # and the scattering backend, so the cache is shared between runs.
+        if use_scattering:
+            cache_dir = f"scatter_cache/{dataset}"
+            os.makedirs(cache_dir, exist_ok=True)
+            train_cache = os.path.join(cache_dir, f"train_{scatter_backend}.pt")
+            test_cache = os.path.join(cache_dir, f"test_{scatter_backend}.pt")
+        else:
+            train_cache, test_cache = None, None
+
+        # with multiple processes, the main process fills the cache. Each process
+        # trains on a shard of the data, and evaluates on the full test set.
+        with main_process_first(distributed):
+            train_loader = get_scattered_loader(train_loader, scattering, device,
+                                                drop_last=True, sample_batches=sample_batches,
+                                                generator=train_gen, cache_path=train_cache,
+                                                distributed=distributed)
+            test_loader = get_scattered_loader(test_loader, scattering, device,
+                                               generator=test_gen, cache_path=test_cache)
+
     rdp_norm = 0
     if input_norm == "BN":
-        # compute noisy data statistics or load from disk if pre-computed
+        # compute noisy data statistics or load from disk if pre-computed.
+        # re-use the pre-computed scattering transform if there is one.
+        pre_scattered = use_scattering and not augment
+        if pre_scattered:
+            bn_loader = zip(*(t.split(1024) for t in train_loader.dataset.tensors))
+            bn_scattering = scattering
+        else:
+            bn_loader = torch.utils.data.DataLoader(
+                train_data, batch_size=1024, shuffle=False, **get_loader_kwargs(4))
+            bn_scattering = nn.Sequential(augmentation, scattering) if augment and use_scattering else scattering
+
         save_dir = f"bn_stats/{dataset}"
         os.makedirs(save_dir, exist_ok=True)
-        bn_stats, rdp_norm = scatter_normalization(train_loader,
-                                                   scattering,
-                                                   K,
-                                                   device,
-                                                   len(train_data),
-                                                   len(train_data),
-                                                   noise_multiplier=bn_noise_multiplier,
-                                                   orders=ORDERS,
-                                                   save_dir=save_dir)
+        with main_process_first(distributed):
+            bn_stats, rdp_norm = scatter_normalization(bn_loader,
+                                                       bn_scattering,
+                                                       K,
+                                                       device,
+                                                       len(train_data),
+                                                       len(train_data),
+                                                       noise_multiplier=bn_noise_multiplier,
+                                                       orders=ORDERS,
+                                                       save_dir=save_dir,
+                                                       pre_scattered=pre_scattered,
+                                                       backend=scatter_backend)
         model = CNNS[dataset](K, input_norm="BN", bn_stats=bn_stats, size=size)
     else:
         model = CNNS[dataset](K, input_norm=input_norm, num_groups=num_groups, size=size)
 
     model.to(device)
 
-    if use_scattering and augment:
-            model = nn.Sequential(scattering, model)
-            train_loader = torch.utils.data.DataLoader(
-                train_data, batch_size=mini_batch_size, shuffle=True,
-                num_workers=1, pin_memory=True, drop_last=True,
-                generator=train_gen)
-    else:
-        # pre-compute the scattering transform if necessery
-        train_loader = get_scattered_loader(train_loader, scattering, device,
-                                            drop_last=True, sample_batches=sample_batches,
-                                            generator=train_gen)
-        test_loader = get_scattered_loader(test_loader, scattering, device,
-                                           generator=test_gen)
+    # optionally store activations and weights in NHWC layout, for faster
+    # convolutions with tensor cores
+    memory_format = torch.channels_last if channels_last else None
+    if channels_last:
+        model.to(memory_format=memory_format)
+
+    # only convert batches that go straight into the CNN. The scattering
+    # transform computed on the fly (with augmentation) needs contiguous inputs.
+    input_memory_format = None if augment and use_scattering else memory_format
+
+    if compile_model:
+        # the vmap privacy engine traces the model functionally, so it isn't compiled
+        assert hasattr(torch, "compile")
+        assert grad_sample_mode == "hooks"
+        model = compile_model(model)
+
+    if augment and use_scattering:
+        # compute the scattering transform of the augmented data on the fly. The
+        # data is augmented in `train` and `test`, outside of the model, so that
+        # checkpoints keep the same keys.
+        model = nn.Sequential(scattering, model)
 
     print(f"model has {get_num_params(model)} parameters")
 
+    # the privacy engine, evaluation and checkpoints use the local model
+    module = model
+    if distributed:
+        model = DistributedDataParallel(model, device_ids=[local_rank],
+                                        gradient_as_bucket_view=True,
+                                        bucket_cap_mb=25,
+                                        broadcast_buffers=False)
+        # don't all-reduce the unclipped gradients in the backward pass. The hook
+        # needs `GradBucket.buffer()` (torch>=1.10); with older versions DDP
+        # keeps reducing them, which is wasteful but harmless.
+        if hasattr(dist, "GradBucket") and hasattr(dist.GradBucket, "buffer"):
+            model.register_comm_hook(state=None, hook=skip_allreduce_hook)
+
     if optim == "SGD":
         optimizer = torch.optim.SGD(model.parameters(), lr=lr,
                                     momentum=momentum,
-                                    nesterov=nesterov)
+                                    nesterov=nesterov,
+                                    **get_optimizer_kwargs(torch.optim.SGD, device))
     else:
-        optimizer = torch.optim.Adam(model.parameters(), lr=lr)
-
-    privacy_engine = PrivacyEngine(
-        model,
+        optimizer = torch.optim.Adam(model.parameters(), lr=lr,
+                                     **get_optimizer_kwargs(torch.optim.Adam, device))
+
+    # opacus computes per-sample gradients with autograd hooks, VmapPrivacyEngine
+    # with `torch.func.vmap`
+    engine_cls = VmapPrivacyEngine if grad_sample_mode == "vmap" else PrivacyEngine
+    # with multiple processes, only the main process adds noise. The gradients
+    # of all processes are averaged after clipping and noising, so the noise
+    # of the averaged gradient is the same as on a single GPU.
+    privacy_engine = engine_cls(
+        module,
         sample_rate=bs / len(train_data),
         alphas=ORDERS,
-        noise_multiplier=noise_multiplier,
+        noise_multiplier=noise_multiplier if rank == 0 else 0,
         max_grad_norm=max_grad_norm,
     )
     privacy_engine.attach(optimizer)
+    if distributed:
+        average_gradients(optimizer, compress=fp16_allreduce)
+
+    test_forward = None
+    if cuda_graph:
+        # capture the evaluation forward pass in a CUDA graph (torch>=1.10). The
+        # inputs must have a fixed shape, so this is incompatible with augmentation.
+        assert hasattr(torch.cuda, "CUDAGraph")
+        assert not augment and not compile_model
+        example = next(iter(test_loader))[0].to(device)
+        if channels_last and example.dim() == 4:
+            example = example.contiguous(memory_format=memory_format)
+        test_forward = CUDAGraphForward(module, example)
+
+    # the sampling rate and noise are fixed, so the RDP of a step is too
+    if noise_multiplier > 0:
+        rdp_per_step = get_renyi_divergence(privacy_engine.sample_rate, noise_multiplier)
 
     best_acc = 0
     flat_count = 0
 
-    for epoch in range(0, epochs):
-        print(f"\nEpoch: {epoch}")
-
-        train_loss, train_acc = train(model, train_loader, optimizer, n_acc_steps=n_acc_steps)
-        test_loss, test_acc = test(model, test_loader)
-
-        if noise_multiplier > 0:
-            rdp_sgd = get_renyi_divergence(
-                privacy_engine.sample_rate, privacy_engine.noise_multiplier
-            ) * privacy_engine.steps
-            epsilon, _ = get_privacy_spent(rdp_norm + rdp_sgd)
-            epsilon2, _ = get_privacy_spent(rdp_sgd)
-            print(f"ε = {epsilon:.3f} (sgd only: ε = {epsilon2:.3f})")
-
-            if max_epsilon is not None and epsilon >= max_epsilon:
-                return
-        else:
-            epsilon = None
-
-        run.log(
-            {
-                "epoch": epoch,
-                "train_loss": train_loss,
-                "train_acc": train_acc,
-                "test_loss": test_loss,
-                "test_acc": test_acc,
-                "epsilon": epsilon,
-            }
-        )
-
-        # stop if we're not making progress
-        if test_acc > best_acc:
-            best_acc = test_acc
-            flat_count = 0
-        else:
-            flat_count += 1
-            if flat_count >= 20 and early_stop:
-                print("plateau...")
-                return
-
-        save_checkpoint(
-            {
-                "epoch": epoch + 1,
-                "model": "scatternet",
-                "state_dict": model.state_dict(),
-                "test_acc": test_acc,
-                "best_acc": best_acc,
-                "optimizer": optimizer.state_dict(),
-            },
-            is_best=True,
-            filename=checkpoint_filename,
-        )
+    # log to wandb from a background thread, so that training doesn't wait on
+    # network I/O
+    logger = BackgroundLogger(run.log)
+
+    try:
+        for epoch in range(0, epochs):
+            print(f"\nEpoch: {epoch}")
+
+            if isinstance(train_loader.sampler, torch.utils.data.DistributedSampler):
+                # shuffle the shards differently in every epoch
+                train_loader.sampler.set_epoch(epoch)
+
+            train_loss, train_acc = train(model, train_loader, optimizer, n_acc_steps=n_acc_steps,
+                                          autocast_dtype=autocast_dtype,
+                                          memory_format=input_memory_format,
+                                          transform=augmentation)
+            test_loss, test_acc = test(module, test_loader, forward=test_forward,
+                                       memory_format=input_memory_format,
+                                       transform=augmentation)
+
+            if distributed:
+                # the processes may compute slightly different accuracies (e.g.,
+                # with different cuDNN algorithms). Take all decisions based on
+                # the accuracy of the main process, so that all stop together.
+                test_acc = torch.tensor(test_acc, dtype=torch.float64, device=device)
+                dist.broadcast(test_acc, src=0)
+                test_acc = test_acc.item()
+
+            if noise_multiplier > 0:
+                rdp_sgd = rdp_per_step * privacy_engine.steps
+                epsilon, _ = get_privacy_spent(rdp_norm + rdp_sgd)
+                epsilon2, _ = get_privacy_spent(rdp_sgd)
+                print(f"ε = {epsilon:.3f} (sgd only: ε = {epsilon2:.3f})")
+
+                if max_epsilon is not None and epsilon >= max_epsilon:
+                    return
+            else:
+                epsilon = None
+
+            logger.log(
+                {
+                    "epoch": epoch,
+                    "train_loss": train_loss,
+                    "train_acc": train_acc,
+                    "test_loss": test_loss,
+                    "test_acc": test_acc,
+                    "epsilon": epsilon,
+                }
+            )
+
+            # stop if we're not making progress
+            is_best = test_acc > best_acc
+            if is_best:
+                best_acc = test_acc
+                flat_count = 0
+            else:
+                flat_count += 1
+                if flat_count >= 20 and early_stop:
+                    print("plateau...")
+                    return
+
+            if rank == 0:
+                save_checkpoint(
+                    {
+                        "epoch": epoch + 1,
+                        "model": "scatternet",
+                        "state_dict": get_state_dict(module),
+                        "test_acc": test_acc,
+                        "best_acc": best_acc,
+                        "optimizer": optimizer.state_dict(),
+                    },
+                    is_best=is_best,
+                    filename=checkpoint_filename,
+                )
+
+    finally:
+        logger.close()
+        if distributed:
+            dist.destroy_process_group()
 
 
 if __name__ == '__main__':
@@ -232,5 +436,13 @@ if __name__ == '__main__':
     parser.add_argument('--sample_batches', action="store_true")
     parser.add_argument('--out_dir', default="out")
     parser.add_argument('--device', default="cuda")
+    parser.add_argument('--num_workers', type=int, default=NUM_WORKERS)
+    parser.add_argument('--no_persistent_workers', dest='persistent_workers', action='store_false')
+    parser.add_argument('--grad_sample_mode', default="hooks", choices=["hooks", "vmap"])
+    parser.add_argument('--bf16', action="store_true")
+    parser.add_argument('--compile', dest="compile_model", action="store_true")
+    parser.add_argument('--cuda_graph', action="store_true")
+    parser.add_argument('--channels_last', action="store_true")
+    parser.add_argument('--fp16_allreduce', action="store_true")
     args = parser.parse_args()
     main(**vars(args))
@@ -1,12 +1,19 @@
 import torch
+import torch.nn as nn
+import torch.nn.functional as F
 from torchvision import datasets, transforms
 from kymatio.torch import Scattering2D
 import os
+import importlib.util
+import inspect
 import pickle
 import numpy as np
 import logging
 
 
+CIFAR10_MEAN = [0.485, 0.456, 0.406]
+CIFAR10_STD = [0.229, 0.224, 0.225]
+
 SHAPES = {
     "cifar10": (32, 32, 3),
     "cifar10_500K": (32, 32, 3),
@@ -15,30 +22,50 @@ SHAPES = {
 }
 
 
-def get_scatter_transform(dataset):
+def get_loader_kwargs(num_workers=1, persistent_workers=False, prefetch_factor=4):
+    # DataLoader worker settings. Persistent workers and prefetching only apply
+    # when loading with worker processes (and require torch>=1.7)
+    kwargs = {"num_workers": num_workers, "pin_memory": True}
+    if num_workers > 0 and "persistent_workers" in inspect.signature(torch.utils.data.DataLoader).parameters:
+        kwargs.update(persistent_workers=persistent_workers, prefetch_factor=prefetch_factor)
+    return kwargs
+
+
+def get_scatter_backend():
+    # kymatio's `torch_skcuda` backend calls cuFFT directly, with kernels for
+    # the modulus and subsampling compiled with cupy. It only runs on the GPU.
+    if not torch.cuda.is_available():
+        return "torch"
+    if any(importlib.util.find_spec(m) is None for m in ("cupy", "skcuda")):
+        return "torch"
+    return "torch_skcuda"
+
+
+def get_scatter_transform(dataset, backend="torch"):
     shape = SHAPES[dataset]
-    scattering = Scattering2D(J=2, shape=shape[:2])
+    scattering = Scattering2D(J=2, shape=shape[:2], backend=backend)
     K = 81 * shape[2]
     (h, w) = shape[:2]
     return scattering, K, (h//4, w//4)
 
 
-def get_data(name, augment=False, **kwargs):
+def get_data(name, augment=False, normalize=True, **kwargs):
+    # with `normalize=False`, CIFAR-10 images are not normalized (e.g., because
+    # this is done on the device with `Augmentation`)
     if name == "cifar10":
-        normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                         std=[0.229, 0.224, 0.225])
+        normalize = [transforms.Normalize(mean=CIFAR10_MEAN, std=CIFAR10_STD)] if normalize else []
 
         if augment:
             train_transforms = [
                     transforms.RandomHorizontalFlip(),
                     transforms.RandomCrop(32, 4),
                     transforms.ToTensor(),
-                    normalize,
+                    *normalize,
                 ]
         else:
             train_transforms = [
                 transforms.ToTensor(),
-                normalize,
+                *normalize,
             ]
 
         train_set = datasets.CIFAR10(root=".data", train=True,
@@ -47,7 +74,7 @@ def get_data(name, augment=False, **kwargs):
 
         test_set = datasets.CIFAR10(root=".data", train=False,
                                     transform=transforms.Compose(
-                                        [transforms.ToTensor(), normalize]
+                                        [transforms.ToTensor(), *normalize]
                                     ))
 
     elif name == "fmnist":
@@ -72,20 +99,19 @@ def get_data(name, augment=False, **kwargs):
 
         # extended version of CIFAR-10 with pseudo-labelled tinyimages
 
-        normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                         std=[0.229, 0.224, 0.225])
+        normalize = [transforms.Normalize(mean=CIFAR10_MEAN, std=CIFAR10_STD)] if normalize else []
 
         if augment:
             train_transforms = [
                 transforms.RandomHorizontalFlip(),
                 transforms.RandomCrop(32, 4),
                 transforms.ToTensor(),
-                normalize,
+                *normalize,
             ]
         else:
             train_transforms = [
                 transforms.ToTensor(),
-                normalize,
+                *normalize,
             ]
 
         train_set = SemiSupervisedDataset(kwargs['aux_data_filename'],
@@ -100,6 +126,86 @@ def get_data(name, augment=False, **kwargs):
     return train_set, test_set
 
 
+def to_float(x):
+    # convert uint8 images (as loaded with `to_tensor_dataset(..., raw=True)`)
+    # to floats in [0, 1], as torchvision's ToTensor does
+    if x.dtype == torch.uint8:
+        x = x.float().div_(255)
+    return x
+
+
+class ToFloat(nn.Module):
+    def forward(self, x):
+        return to_float(x)
+
+
+class Augmentation(nn.Module):
+    # random horizontal flips and random crops of zero-padded images (as with
+    # torchvision's RandomHorizontalFlip and RandomCrop) followed by
+    # normalization, for a batch of images on the device. In eval mode, the
+    # images are only normalized. uint8 images are converted to floats after
+    # cropping, so that the cropping moves 4x fewer bytes.
+    def __init__(self, mean, std, padding=4):
+        super(Augmentation, self).__init__()
+        self.padding = padding
+        self.register_buffer("mean", torch.tensor(mean).view(1, -1, 1, 1))
+        self.register_buffer("std", torch.tensor(std).view(1, -1, 1, 1))
+
+    def forward(self, x):
+        if self.training:
+            n, _, h, w = x.shape
+
+            flip = torch.rand(n, device=x.device) < 0.5
+            x = torch.where(flip.view(-1, 1, 1, 1), x.flip(3), x)
+
+            # pick a random h x w window in each padded image
+            x = F.pad(x, [self.padding] * 4).permute(0, 2, 3, 1)
+            i = torch.randint(0, 2 * self.padding + 1, (n, 1, 1), device=x.device)
+            j = torch.randint(0, 2 * self.padding + 1, (n, 1, 1), device=x.device)
+            rows = i + torch.arange(h, device=x.device).view(1, -1, 1)
+            cols = j + torch.arange(w, device=x.device).view(1, 1, -1)
+            x = x[torch.arange(n, device=x.device).view(-1, 1, 1), rows, cols]
+            # the scattering transform needs contiguous (NCHW) images
+            x = x.permute(0, 3, 1, 2).contiguous()
+
+        return (to_float(x) - self.mean) / self.std
+
+
+def get_augmentation(name):
+    # the data augmentation to apply on the device, to data loaded with
+    # `get_data(name, normalize=False)` or `to_tensor_dataset(..., raw=True)`
+    if name in ["cifar10", "cifar10_500K"]:
+        return Augmentation(CIFAR10_MEAN, CIFAR10_STD)
+
+    # (F)MNIST isn't augmented or normalized
+    return ToFloat()
+
+
+def to_tensor_dataset(dataset, raw=False):
+    # convert a torchvision image dataset into an in-memory TensorDataset, by
+    # applying its (deterministic) transforms to all images at once. With
+    # `raw`, the transforms are skipped and the images are kept as uint8, to be
+    # converted on the device (e.g., by `get_augmentation`).
+    images = torch.as_tensor(np.asarray(dataset.data))
+    if images.dim() == 3:
+        images = images.unsqueeze(-1)
+    images = images.permute(0, 3, 1, 2)
+
+    ts = [] if raw else getattr(dataset.transform, "transforms", [dataset.transform])
+    for t in ts:
+        if isinstance(t, transforms.ToTensor):
+            images = images.float().div(255)
+        elif isinstance(t, transforms.Normalize):
+            mean = torch.as_tensor(t.mean).view(1, -1, 1, 1)
+            std = torch.as_tensor(t.std).view(1, -1, 1, 1)
+            images = (images - mean) / std
+        else:
+            raise ValueError(f"cannot apply transform {t} to a whole dataset")
+
+    targets = torch.as_tensor(np.asarray(dataset.targets))
+    return torch.utils.data.TensorDataset(images.contiguous(), targets)
+
+
 class SemiSupervisedDataset(torch.utils.data.Dataset):
     def __init__(self,
                  aux_data_filename=None,
@@ -259,7 +365,7 @@ def get_scattered_dataset(loader, scattering, device, data_size):
 
     num = 0
     for (data, target) in loader:
-        data, target = data.to(device), target.to(device)
+        data, target = data.to(device, non_blocking=True), target.to(device, non_blocking=True)
         if scattering is not None:
             data = scattering(data)
         scatters.append(data)
@@ -285,22 +391,49 @@ def get_scattered_loader(
         device,
         drop_last=False,
         sample_batches=False,
-        generator=None):
+        generator=None,
+        cache_path=None,
+        distributed=False):
     # pre-compute a scattering transform (if there is one) and return
-    # a DataLoader
-
-    scatters = []
-    targets = []
-
-    for (data, target) in loader:
-        data, target = data.to(device), target.to(device)
-        if scattering is not None:
-            data = scattering(data)
-        scatters.append(data)
-        targets.append(target)
-
-    scatters = torch.cat(scatters, axis=0)
-    targets = torch.cat(targets, axis=0)
+    # a DataLoader. If `cache_path` is given, the pre-computed features are
+    # saved there and loaded instead of being re-computed in later runs.
+    # If `distributed`, the DataLoader yields this process' shard of the data.
+
+    if cache_path is not None and os.path.exists(cache_path):
+        print(f"loading scattered features from {cache_path}")
+        cache = torch.load(cache_path)
+        scatters = cache["scatters"].to(device)
+        targets = cache["targets"].to(device)
+
+        # restore the generator to the state it would be in after a pass over
+        # `loader`, so that cached and non-cached runs see the same batches
+        if generator is not None:
+            generator.set_state(cache["generator_state"])
+    else:
+        scatters = []
+        targets = []
+
+        for (data, target) in loader:
+            data, target = data.to(device, non_blocking=True), target.to(device, non_blocking=True)
+            if scattering is not None:
+                data = scattering(data)
+            scatters.append(data)
+            targets.append(target)
+
+        scatters = torch.cat(scatters, axis=0)
+        targets = torch.cat(targets, axis=0)
+
+        if cache_path is not None:
+            # write to a temporary file and rename it, so that an interrupted
+            # run never leaves a truncated cache behind
+            print(f"saving scattered features to {cache_path}")
+            tmp_path = f"{cache_path}.tmp.{os.getpid()}"
+            torch.save({
+                "scatters": scatters.cpu(),
+                "targets": targets.cpu(),
+                "generator_state": generator.get_state() if generator is not None else None,
+            }, tmp_path)
+            os.replace(tmp_path, cache_path)
 
     data = torch.utils.data.TensorDataset(scatters, targets)
 
@@ -309,6 +442,15 @@ def get_scattered_loader(
         return torch.utils.data.DataLoader(data, batch_sampler=sampler,
                                            num_workers=0, pin_memory=False,
                                            generator=generator)
+    elif distributed:
+        shuffle = isinstance(loader.sampler, torch.utils.data.RandomSampler)
+        sampler = torch.utils.data.DistributedSampler(data, shuffle=shuffle, drop_last=drop_last)
+        return torch.utils.data.DataLoader(data,
+                                           batch_size=loader.batch_size,
+                                           sampler=sampler,
+                                           num_workers=0,
+                                           pin_memory=False,
+                                           drop_last=drop_last)
     else:
         shuffle = isinstance(loader.sampler, torch.utils.data.RandomSampler)
         return torch.utils.data.DataLoader(data,
@@ -1,8 +1,11 @@
 import os
 import math
+import types
 
 import numpy as np
 import torch
+import torch.nn as nn
+import torch.nn.functional as F
 import opacus.privacy_analysis as tf_privacy
 
 ORDERS = [1 + x / 10.0 for x in range(1, 100)] + list(range(12, 64))
@@ -84,11 +87,20 @@ def get_noise_mul_privbyiter(num_samples, batch_size, target_epsilon, epochs, ta
     return mul_low
 
 
+def _feature_means(data, K):
+    # the spatial mean of each feature, and of its square, for each sample
+    data = data.reshape(len(data), K, -1)
+    return data.mean(-1), (data ** 2).mean(-1)
+
+
 def scatter_normalization(train_loader, scattering, K, device,
                           data_size, sample_size,
-                          noise_multiplier=1.0, orders=ORDERS, save_dir=None):
+                          noise_multiplier=1.0, orders=ORDERS, save_dir=None,
+                          pre_scattered=False, backend="torch"):
     # privately compute the mean and variance of scatternet features to normalize
-    # the data.
+    # the data. If `pre_scattered`, `train_loader` yields scatternet features
+    # rather than images. `backend` is the kymatio backend that computes the
+    # features; stats of other backends than "torch" are saved separately.
 
     rdp = 0
     epsilon_norm = np.inf
@@ -99,10 +111,11 @@ def scatter_normalization(train_loader, scattering, K, device,
         epsilon_norm, _ = get_privacy_spent(rdp)
 
     # try loading pre-computed stats
-    use_scattering = scattering is not None
+    use_scattering = scattering is not None or pre_scattered
     assert use_scattering
-    mean_path = os.path.join(save_dir, f"mean_bn_{sample_size}_{noise_multiplier}_{use_scattering}.npy")
-    var_path = os.path.join(save_dir, f"var_bn_{sample_size}_{noise_multiplier}_{use_scattering}.npy")
+    suffix = "" if backend == "torch" else f"_{backend}"
+    mean_path = os.path.join(save_dir, f"mean_bn_{sample_size}_{noise_multiplier}_{use_scattering}{suffix}.npy")
+    var_path = os.path.join(save_dir, f"var_bn_{sample_size}_{noise_multiplier}_{use_scattering}{suffix}.npy")
 
     print(f"Using BN stats for {sample_size}/{data_size} samples")
     print(f"With noise_mul={noise_multiplier}, we get ε_norm = {epsilon_norm:.3f}")
@@ -114,35 +127,36 @@ def scatter_normalization(train_loader, scattering, K, device,
         print(mean.shape, var.shape)
     except OSError:
 
-        # compute the scattering transform and the mean and squared mean of features
-        scatters = []
+        # compute the scattering transform and the mean and squared mean of features.
+        # Each batch is reduced to per-sample means on the device, and only those
+        # are copied to the host.
+        scatter_means = []
+        scatter_sq_means = []
         mean = 0
         sq_mean = 0
         count = 0
         for idx, (data, target) in enumerate(train_loader):
             with torch.no_grad():
-                data = data.to(device)
-                if scattering is not None:
-                    data = scattering(data).view(-1, K, data.shape[2]//4, data.shape[3]//4)
+                data = data.to(device, non_blocking=True)
+                if not pre_scattered:
+                    data = scattering(data)
+                data = data.view(-1, K, data.shape[-2], data.shape[-1])
+                batch_means, batch_sq_means = _feature_means(data, K)
                 if noise_multiplier == 0:
-                    data = data.reshape(len(data), K, -1).mean(-1)
-                    mean += data.sum(0).cpu().numpy()
-                    sq_mean += (data**2).sum(0).cpu().numpy()
+                    # accumulate on the device, and copy to the host only once
+                    mean += batch_means.sum(0)
+                    sq_mean += (batch_means ** 2).sum(0)
                 else:
-                    scatters.append(data.cpu().numpy())
+                    scatter_means.append(batch_means.cpu().numpy())
+                    scatter_sq_means.append(batch_sq_means.cpu().numpy())
 
                 count += len(data)
                 if count >= sample_size:
                     break
 
         if noise_multiplier > 0:
-            scatters = np.concatenate(scatters, axis=0)
-            scatters = np.transpose(scatters, (0, 2, 3, 1))
-
-            scatters = scatters[:sample_size]
-
             # s x K
-            scatter_means = np.mean(scatters.reshape(len(scatters), -1, K), axis=1)
+            scatter_means = np.concatenate(scatter_means, axis=0)[:sample_size]
             norms = np.linalg.norm(scatter_means, axis=-1)
 
             # technically a small privacy leak, sue me...
@@ -154,8 +168,7 @@ def scatter_normalization(train_loader, scattering, K, device,
                                      size=mean.shape) / sample_size
 
             # s x K
-            scatter_sq_means = np.mean((scatters ** 2).reshape(len(scatters), -1, K),
-                                       axis=1)
+            scatter_sq_means = np.concatenate(scatter_sq_means, axis=0)[:sample_size]
             norms = np.linalg.norm(scatter_sq_means, axis=-1)
 
             # technically a small privacy leak, sue me...
@@ -167,8 +180,8 @@ def scatter_normalization(train_loader, scattering, K, device,
                                         size=sq_mean.shape) / sample_size
             var = np.maximum(sq_mean - mean ** 2, 0)
         else:
-            mean /= count
-            sq_mean /= count
+            mean = mean.cpu().numpy() / count
+            sq_mean = sq_mean.cpu().numpy() / count
             var = np.maximum(sq_mean - mean ** 2, 0)
 
         if save_dir is not None:
@@ -182,6 +195,130 @@ def scatter_normalization(train_loader, scattering, K, device,
     return (mean, var), rdp
 
 
+class VmapPrivacyEngine(object):
+    # A replacement for opacus' `PrivacyEngine` (v0.13) that computes the
+    # per-sample gradients of the cross-entropy loss with `torch.func.vmap`
+    # instead of per-layer autograd hooks (requires torch>=2.0).
+    #
+    # Leading stages of an `nn.Sequential` without trainable parameters
+    # (e.g., the scattering transform) are applied to the whole batch outside
+    # of `vmap`.
+
+    def __init__(self, module, sample_rate, alphas=ORDERS,
+                 noise_multiplier=1.0, max_grad_norm=1.0):
+        if not hasattr(torch, "func"):
+            raise RuntimeError("per-sample gradients with vmap require torch>=2.0")
+
+        self.module = module
+        self.sample_rate = sample_rate
+        self.alphas = alphas
+        self.noise_multiplier = noise_multiplier
+        self.max_grad_norm = max_grad_norm
+        self.steps = 0
+        self.optimizer = None
+
+        self.stages = []
+        self.model = module
+        if isinstance(module, nn.Sequential):
+            modules = list(module)
+            while len(modules) > 1 and not any(p.requires_grad for p in modules[0].parameters()):
+                self.stages.append(modules.pop(0))
+            self.model = modules[0] if len(modules) == 1 else nn.Sequential(*modules)
+
+        self._summed_grads = {}
+        self._batch_size = 0
+
+    def attach(self, optimizer):
+        # patch the optimizer the same way as opacus does
+        def dp_zero_grad(self):
+            self.privacy_engine.zero_grad()
+            self.original_zero_grad()
+
+        def dp_step(self, closure=None):
+            self.privacy_engine.step()
+            self.original_step(closure)
+
+        def virtual_step(self):
+            # per-sample gradients are clipped and accumulated in `per_sample_backward`
+            pass
+
+        optimizer.privacy_engine = self
+        optimizer.original_step = optimizer.step
+        optimizer.step = types.MethodType(dp_step, optimizer)
+
+        optimizer.original_zero_grad = optimizer.zero_grad
+        optimizer.zero_grad = types.MethodType(dp_zero_grad, optimizer)
+
+        optimizer.virtual_step = types.MethodType(virtual_step, optimizer)
+
+        self.optimizer = optimizer
+
+    def per_sample_backward(self, data, target):
+        # compute, clip and accumulate the per-sample gradients of the
+        # cross-entropy loss on a batch, and return the model outputs
+        from torch.func import functional_call, grad, vmap
+
+        with torch.no_grad():
+            for stage in self.stages:
+                data = stage(data)
+
+        params = {}
+        frozen = dict(self.model.named_buffers())
+        for name, p in self.model.named_parameters():
+            if p.requires_grad:
+                params[name] = p.detach()
+            else:
+                frozen[name] = p
+
+        def compute_loss(params, x, y):
+            output = functional_call(self.model, (params, frozen), (x.unsqueeze(0),))
+            return F.cross_entropy(output, y.unsqueeze(0)), output.squeeze(0)
+
+        grads, output = vmap(grad(compute_loss, has_aux=True),
+                             in_dims=(None, 0, 0))(params, data, target)
+
+        # clip the norm of the flattened per-sample gradients, like opacus'
+        # `ConstantFlatClipper`. This is done in full precision, even if the
+        # forward pass uses autocast.
+        with torch.autocast(data.device.type, enabled=False):
+            grads = {name: g.float() for name, g in grads.items()}
+            norms = torch.stack([g.reshape(len(g), -1).norm(2, dim=-1) for g in grads.values()])
+            norms = norms.norm(2, dim=0)
+            clip_factor = (self.max_grad_norm / (norms + 1e-6)).clamp(max=1.0)
+
+            for name, g in grads.items():
+                summed_grad = torch.einsum("i,i...", clip_factor, g)
+                if name in self._summed_grads:
+                    self._summed_grads[name] += summed_grad
+                else:
+                    self._summed_grads[name] = summed_grad
+
+        self._batch_size += len(target)
+        return output
+
+    def step(self):
+        # average the clipped gradients and add noise, as opacus does
+        if self._batch_size == 0:
+            raise ValueError("You need to call per_sample_backward first")
+
+        self.steps += 1
+        for name, p in self.model.named_parameters():
+            if not p.requires_grad:
+                continue
+
+            summed_grad = self._summed_grads[name]
+            if self.noise_multiplier > 0 and self.max_grad_norm > 0:
+                summed_grad += torch.normal(0, self.noise_multiplier * self.max_grad_norm,
+                                            summed_grad.shape, device=summed_grad.device)
+            p.grad = summed_grad / self._batch_size
+
+        self.zero_grad()
+
+    def zero_grad(self):
+        self._summed_grads = {}
+        self._batch_size = 0
+
+
 def priv_by_iter_guarantees(epochs, batch_size, samples, noise_multiplier, delta=1e-5, verbose=True):
     """Tabulating position-dependent privacy guarantees."""
     if noise_multiplier == 0:
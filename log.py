@@ -1,7 +1,9 @@
 import numpy as np
 import os
+import queue
 import shutil
 import sys
+import threading
 from torch.utils.tensorboard import SummaryWriter
 import torch
 
@@ -63,3 +65,31 @@ class Logger(object):
         if self.writer is None or scalar_value is None:
             return
         self.writer.add_scalar(tag, scalar_value, global_step)
+
+
+class BackgroundLogger(object):
+    # calls `log_fn` (e.g., a wandb run's `log`) from a background thread
+    def __init__(self, log_fn):
+        self.log_fn = log_fn
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                return
+            try:
+                self.log_fn(data)
+            except Exception as e:
+                # keep logging the next records
+                print(f"logging failed: {e!r}")
+
+    def log(self, data):
+        self.queue.put(data)
+
+    def close(self):
+        # wait until all queued logs are written
+        self.queue.put(None)
+        self.thread.join()
@@ -103,7 +103,7 @@ class CIFAR10_CNN(nn.Module):
         if self.in_channels != 3:
             x = self.norm(x.view(-1, self.in_channels, 8, 8))
         x = self.features(x)
-        x = x.view(x.size(0), -1)
+        x = x.reshape(x.size(0), -1)
         x = self.classifier(x)
         return x
 
@@ -158,7 +158,7 @@ class MNIST_CNN(nn.Module):
         if self.in_channels != 1:
             x = self.norm(x.view(-1, self.in_channels, 7, 7))
         x = self.features(x)
-        x = x.view(x.size(0), -1)
+        x = x.reshape(x.size(0), -1)
         x = self.classifier(x)
         return x
 
@@ -0,0 +1,55 @@
+import torch
+import torch.nn as nn
+
+from data import get_augmentation, get_scatter_transform
+from models import CNNS
+import train_utils
+
+
+def get_batches(n=8, batch_size=4):
+    images = torch.randint(0, 256, (n, 3, 32, 32), dtype=torch.uint8)
+    targets = torch.randint(0, 10, (n,))
+    data = torch.utils.data.TensorDataset(images, targets)
+    return torch.utils.data.DataLoader(data, batch_size=batch_size)
+
+
+def test_augmented_scattering():
+    # augmentation followed by the scattering transform, in train mode (as in
+    # training and when computing the BN statistics) and in eval mode
+    augmentation = get_augmentation("cifar10")
+    scattering, K, _ = get_scatter_transform("cifar10", backend="torch")
+    model = nn.Sequential(augmentation, scattering, CNNS["cifar10"](K, input_norm="GroupNorm", num_groups=27))
+
+    x, _ = next(iter(get_batches()))
+    for mode in (True, False):
+        model.train(mode)
+        output = model(x)
+        assert output.shape == (len(x), 10)
+        assert torch.isfinite(output).all()
+
+
+def test_train_with_augmentation():
+    augmentation = get_augmentation("cifar10")
+    scattering, K, _ = get_scatter_transform("cifar10", backend="torch")
+    model = nn.Sequential(scattering, CNNS["cifar10"](K, input_norm="GroupNorm", num_groups=27))
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+
+    loader = get_batches()
+    train_loss, _ = train_utils.train(model, loader, optimizer, transform=augmentation)
+    test_loss, _ = train_utils.test(model, loader, transform=augmentation)
+    assert augmentation.training is False
+    assert torch.isfinite(torch.tensor([train_loss, test_loss])).all()
+
+
+def test_augmentation_of_uint8_images():
+    # uint8 images give the same result as images converted to floats in [0, 1]
+    augmentation = get_augmentation("cifar10")
+    x, _ = next(iter(get_batches()))
+    for mode in (True, False):
+        augmentation.train(mode)
+        torch.manual_seed(0)
+        y_uint8 = augmentation(x)
+        torch.manual_seed(0)
+        y_float = augmentation(x.float() / 255)
+        assert y_uint8.is_contiguous()
+        assert torch.allclose(y_uint8, y_float, atol=1e-6)
@@ -0,0 +1,58 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from dp_utils import VmapPrivacyEngine
+from models import CNNS
+
+
+def clipped_mean_grad(model, data, target, max_grad_norm):
+    # the mean of the per-sample gradients clipped to `max_grad_norm`,
+    # computed one sample at a time
+    params = [p for p in model.parameters() if p.requires_grad]
+    summed = [torch.zeros_like(p) for p in params]
+    for x, y in zip(data, target):
+        loss = F.cross_entropy(model(x.unsqueeze(0)), y.unsqueeze(0))
+        grads = torch.autograd.grad(loss, params)
+        norm = torch.cat([g.reshape(-1) for g in grads]).norm(2)
+        clip_factor = (max_grad_norm / (norm + 1e-6)).clamp(max=1.0)
+        for s, g in zip(summed, grads):
+            s += clip_factor * g
+    return [s / len(data) for s in summed]
+
+
+def test_vmap_privacy_engine():
+    torch.manual_seed(0)
+    # a leading stage without parameters is applied outside of vmap
+    model = nn.Sequential(nn.Identity(), CNNS["mnist"](1))
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    max_grad_norm = 0.1
+    privacy_engine = VmapPrivacyEngine(model, sample_rate=0.01, noise_multiplier=0,
+                                       max_grad_norm=max_grad_norm)
+    privacy_engine.attach(optimizer)
+    assert optimizer.privacy_engine is privacy_engine
+
+    data = torch.rand(6, 1, 28, 28)
+    target = torch.randint(0, 10, (6,))
+    expected = clipped_mean_grad(model, data, target, max_grad_norm)
+
+    # accumulate the per-sample gradients over two mini-batches
+    output = privacy_engine.per_sample_backward(data[:4], target[:4])
+    assert output.shape == (4, 10)
+    optimizer.virtual_step()
+    privacy_engine.per_sample_backward(data[4:], target[4:])
+    assert privacy_engine._batch_size == 6
+
+    optimizer.step()
+    assert privacy_engine.steps == 1
+    for p, g in zip(model.parameters(), expected):
+        assert torch.allclose(p.grad, g, atol=1e-6)
+
+    # the accumulated state is reset after a step, and by `zero_grad`
+    assert privacy_engine._summed_grads == {}
+    assert privacy_engine._batch_size == 0
+    privacy_engine.per_sample_backward(data, target)
+    optimizer.zero_grad()
+    assert privacy_engine._summed_grads == {}
+    assert privacy_engine._batch_size == 0
+    assert privacy_engine.steps == 1
@@ -0,0 +1,39 @@
+import copy
+
+import pytest
+import torch
+import torch.nn.functional as F
+from opacus import PrivacyEngine
+
+from models import CNNS
+import train_utils
+
+
+@pytest.mark.skipif(not hasattr(torch, "compile"), reason="requires torch>=2.0")
+def test_compiled_model_per_sample_gradients():
+    # opacus' hooks still compute the per-sample gradients of a compiled model
+    torch.manual_seed(0)
+    model = CNNS["mnist"](1)
+    data = torch.rand(2, 4, 1, 28, 28)
+    target = torch.randint(0, 10, (2, 4))
+
+    grad_samples = []
+    grads = []
+    for compile_model in (False, True):
+        m = copy.deepcopy(model)
+        optimizer = torch.optim.SGD(m.parameters(), lr=0.1)
+        privacy_engine = PrivacyEngine(m, sample_rate=0.01, noise_multiplier=0, max_grad_norm=0.1)
+        privacy_engine.attach(optimizer)
+        forward = train_utils.compile_model(m) if compile_model else m
+
+        # two steps, so that the second uses the updated parameters
+        for x, y in zip(data, target):
+            F.cross_entropy(forward(x), y).backward()
+            grad_samples.append([p.grad_sample.clone() for p in m.parameters()])
+            optimizer.step()
+            grads.append([p.grad.clone() for p in m.parameters()])
+            train_utils.zero_grad(optimizer)
+
+    for expected, actual in zip(grad_samples[:2] + grads[:2], grad_samples[2:] + grads[2:]):
+        for e, a in zip(expected, actual):
+            assert torch.allclose(e, a, atol=1e-5)
@@ -1,5 +1,9 @@
+import contextlib
+import inspect
+
 import torch
 import torch.nn.functional as F
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
 
 
 def get_device(device_name="cuda"):
@@ -9,9 +13,122 @@ def get_device(device_name="cuda"):
     return device
 
 
-def train(model, train_loader, optimizer, n_acc_steps=1):
+def get_optimizer_kwargs(optimizer_cls, device):
+    # use the fused or multi-tensor ("foreach") implementation of an optimizer,
+    # if the installed torch has one
+    params = inspect.signature(optimizer_cls).parameters
+    if device.type == "cuda" and "fused" in params:
+        return {"fused": True}
+    if "foreach" in params:
+        return {"foreach": True}
+    return {}
+
+
+def compile_model(model):
+    # specialize the model to its static input shapes (torch>=2.1). opacus'
+    # hooks keep references to the activations of the modules until the
+    # backward pass, so CUDA graphs (which reuse their output buffers from one
+    # call to the next) aren't used.
+    torch._dynamo.config.cache_size_limit = 64
+    return torch.compile(model, mode="max-autotune-no-cudagraphs", dynamic=False)
+
+
+def zero_grad(optimizer):
+    # reset the gradients to None instead of filling them with zeros, and reset
+    # the per-sample state of the privacy engine (if one is attached)
+    privacy_engine = getattr(optimizer, "privacy_engine", None)
+    if privacy_engine is not None:
+        privacy_engine.zero_grad()
+
+    for group in optimizer.param_groups:
+        for p in group["params"]:
+            p.grad = None
+
+
+@contextlib.contextmanager
+def main_process_first(distributed):
+    # let the main process run a block first (e.g., to compute and cache data on
+    # disk), before the other processes run it and load the cached data
+    is_main = not distributed or torch.distributed.get_rank() == 0
+    if not is_main:
+        torch.distributed.barrier()
+    yield
+    if distributed and is_main:
+        torch.distributed.barrier()
+
+
+def skip_allreduce_hook(state, bucket):
+    # a DDP communication hook that leaves the gradients of a bucket as they are.
+    # The privacy engine replaces them with clipped and noised gradients anyway,
+    # which are averaged in `average_gradients` (torch>=1.10).
+    fut = torch.futures.Future()
+    fut.set_result(bucket.buffer())
+    return fut
+
+
+def average_gradients(optimizer, compress=False):
+    # average the gradients over all processes right before the parameters are
+    # updated, i.e., after the privacy engine has clipped and noised them. This
+    # has to be done here rather than in DDP's backward pass, as the privacy
+    # engine replaces the gradients with its own in `optimizer.step()`.
+    # The gradients are reduced in a single call, optionally in float16.
+    original_step = optimizer.original_step
+    world_size = torch.distributed.get_world_size()
+
+    def step(closure=None):
+        grads = [p.grad for group in optimizer.param_groups
+                 for p in group["params"] if p.grad is not None]
+        flat_grads = _flatten_dense_tensors(grads)
+        if compress:
+            flat_grads = flat_grads.half()
+        flat_grads.div_(world_size)
+        torch.distributed.all_reduce(flat_grads)
+        for g, avg in zip(grads, _unflatten_dense_tensors(flat_grads, grads)):
+            g.copy_(avg)
+        return original_step(closure)
+
+    optimizer.original_step = step
+
+
+def prefetch(loader, device):
+    # iterate over the (data, target) batches of a loader on the device. On GPU,
+    # the next batch is copied on a separate CUDA stream while the current batch
+    # is being processed.
+    if device.type != "cuda":
+        for data, target in loader:
+            yield data.to(device), target.to(device)
+        return
+
+    stream = torch.cuda.Stream(device=device)
+    current_stream = torch.cuda.current_stream(device)
+
+    def copy(batch):
+        if batch is None:
+            return None
+        with torch.cuda.stream(stream):
+            return [t.to(device, non_blocking=True) for t in batch]
+
+    batches = iter(loader)
+    next_batch = copy(next(batches, None))
+    while next_batch is not None:
+        # wait for the copy, and don't let the copy stream reuse the memory of
+        # the batch until the current stream is done with it
+        current_stream.wait_stream(stream)
+        batch = next_batch
+        for t in batch:
+            t.record_stream(current_stream)
+
+        next_batch = copy(next(batches, None))
+        yield batch
+
+
+def train(model, train_loader, optimizer, n_acc_steps=1, autocast_dtype=None,
+          memory_format=None, transform=None):
+    # `transform` (e.g., data augmentation) is applied to each batch on the device
     device = next(model.parameters()).device
     model.train()
+    if transform is not None:
+        transform.train()
     num_examples = 0
     correct = 0
     train_loss = 0
@@ -23,32 +140,51 @@ def train(model, train_loader, optimizer, n_acc_steps=1):
     bs = train_loader.batch_size if train_loader.batch_size is not None else train_loader.batch_sampler.batch_size
     print(f"training on {num_batches} batches of size {bs}")
 
-    for batch_idx, (data, target) in enumerate(train_loader):
+    for batch_idx, (data, target) in enumerate(prefetch(train_loader, device)):
 
         if batch_idx > num_batches - 1:
             break
 
-        data, target = data.to(device), target.to(device)
+        if transform is not None:
+            with torch.no_grad():
+                data = transform(data)
+        if memory_format is not None and data.dim() == 4:
+            data = data.contiguous(memory_format=memory_format)
 
-        output = model(data)
+        # optionally run the forward pass in lower precision (e.g., bfloat16)
+        if autocast_dtype is not None:
+            autocast = torch.autocast(device.type, dtype=autocast_dtype)
+        else:
+            autocast = contextlib.nullcontext()
 
-        loss = F.cross_entropy(output, target)
-        loss.backward()
+        privacy_engine = getattr(optimizer, "privacy_engine", None)
+        if hasattr(privacy_engine, "per_sample_backward"):
+            # the privacy engine computes the per-sample gradients itself
+            with autocast:
+                output = privacy_engine.per_sample_backward(data, target)
+        else:
+            with autocast:
+                output = model(data)
+                loss = F.cross_entropy(output, target)
+            loss.backward()
 
         if ((batch_idx + 1) % n_acc_steps == 0) or ((batch_idx + 1) == len(train_loader)):
             optimizer.step()
-            optimizer.zero_grad()
+            zero_grad(optimizer)
         else:
             with torch.no_grad():
                 # accumulate per-example gradients but don't take a step yet
                 optimizer.virtual_step()
 
-        pred = output.max(1, keepdim=True)[1]
-        correct += pred.eq(target.view_as(pred)).sum().item()
-        train_loss += F.cross_entropy(output, target, reduction='sum').item()
+        # accumulate the statistics on the device, to avoid a sync per batch
+        with torch.no_grad():
+            pred = output.max(1, keepdim=True)[1]
+            correct += pred.eq(target.view_as(pred)).sum()
+            train_loss += F.cross_entropy(output.float(), target, reduction='sum')
         num_examples += len(data)
 
-    train_loss /= num_examples
+    correct = int(correct)
+    train_loss = float(train_loss) / num_examples
     train_acc = 100. * correct / num_examples
 
     print(f'Train set: Average loss: {train_loss:.4f}, '
@@ -57,23 +193,64 @@ def train(model, train_loader, optimizer, n_acc_steps=1):
     return train_loss, train_acc
 
 
-def test(model, test_loader):
+class CUDAGraphForward(object):
+    # the eval-mode forward pass of a model, captured in a CUDA graph for
+    # batches of a fixed shape (torch>=1.10). Batches of other shapes fall
+    # back to the regular forward pass.
+    def __init__(self, model, example, warmup=3):
+        self.model = model
+        self.static_input = example.clone()
+
+        model.eval()
+        with torch.no_grad():
+            # warm up on a side stream before capturing, as required by CUDA graphs
+            stream = torch.cuda.Stream(device=example.device)
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(warmup):
+                    model(self.static_input)
+            torch.cuda.current_stream().wait_stream(stream)
+
+            self.graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(self.graph):
+                self.static_output = model(self.static_input)
+
+    def __call__(self, data):
+        if data.shape != self.static_input.shape:
+            return self.model(data)
+
+        # the output is overwritten by the next call
+        self.static_input.copy_(data)
+        self.graph.replay()
+        return self.static_output
+
+
+def test(model, test_loader, forward=None, memory_format=None, transform=None):
     device = next(model.parameters()).device
     model.eval()
+    if transform is not None:
+        transform.eval()
     num_examples = 0
     test_loss = 0
     correct = 0
 
+    if forward is None:
+        forward = model
+
     with torch.no_grad():
-        for data, target in test_loader:
-            data, target = data.to(device), target.to(device)
-            output = model(data)
-            test_loss += F.cross_entropy(output, target, reduction='sum').item()
+        for data, target in prefetch(test_loader, device):
+            if transform is not None:
+                data = transform(data)
+            if memory_format is not None and data.dim() == 4:
+                data = data.contiguous(memory_format=memory_format)
+            output = forward(data)
+            test_loss += F.cross_entropy(output, target, reduction='sum')
             pred = output.max(1, keepdim=True)[1]
-            correct += pred.eq(target.view_as(pred)).sum().item()
+            correct += pred.eq(target.view_as(pred)).sum()
             num_examples += len(data)
 
-    test_loss /= num_examples
+    correct = int(correct)
+    test_loss = float(test_loss) / num_examples
     test_acc = 100. * correct / num_examples
 
     print(f'Test set: Average loss: {test_loss:.4f}, '